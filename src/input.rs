@@ -2,8 +2,7 @@
 // SPDX-License-Identifier: GPL-2.0-or-later
 use std::path::Path;
 
-use anyhow::{anyhow, Context, Result};
-use itertools::Itertools;
+use anyhow::{anyhow, bail, Context, Result};
 use serde::Deserialize;
 
 use crate::video::SourceFrame;
@@ -65,7 +64,9 @@ pub struct CANMessage {
     pub can_id: u32,
     pub is_extended_id: bool,
     pub bus_no: u8,
-    pub data: Vec<u8>,
+    // Boxed slice rather than Vec, as a log can hold millions of these and
+    // the payload never changes size after parsing
+    pub data: Box<[u8]>,
 }
 
 impl Ord for CANMessage {
@@ -80,34 +81,60 @@ impl PartialOrd for CANMessage {
     }
 }
 
+// Parse an unsigned integer field straight from the raw CSV bytes, without
+// first validating the record as UTF-8
+fn parse_field<T>(field: &[u8], radix: u32) -> Result<T>
+where
+    T: TryFrom<u64>,
+    T::Error: std::error::Error + Send + Sync + 'static,
+{
+    if field.is_empty() {
+        bail!("Empty numeric field");
+    }
+    let value = field.iter().try_fold(0u64, |acc, &c| {
+        let digit = (c as char)
+            .to_digit(radix)
+            .ok_or_else(|| anyhow!("Invalid numeric field {:?}", String::from_utf8_lossy(field)))?;
+        acc.checked_mul(radix as u64)
+            .and_then(|acc| acc.checked_add(digit as u64))
+            .ok_or_else(|| {
+                anyhow!(
+                    "Numeric field {:?} too large",
+                    String::from_utf8_lossy(field)
+                )
+            })
+    })?;
+    Ok(T::try_from(value)?)
+}
+
 impl CANMessage {
-    pub fn parse_from(record: &csv::StringRecord, ts_offs: Nanos) -> Result<Self> {
+    pub fn parse_from(record: &csv::ByteRecord, ts_offs: Nanos) -> Result<Self> {
         // in this format, each record has a variable number of fields
         // and we want to concatenate the variable data fields
         let mut fields = record.iter();
 
-        let ts_us: i64 = fields.next().ok_or(anyhow!("Missing ts field"))?.parse()?;
-        let can_id =
-            u32::from_str_radix(fields.next().ok_or(anyhow!("Missing can id field"))?, 16)?;
+        let ts_us: i64 = parse_field(fields.next().ok_or(anyhow!("Missing ts field"))?, 10)?;
+        let can_id = parse_field(fields.next().ok_or(anyhow!("Missing can id field"))?, 16)?;
         let is_extended_id = fields
             .next()
             .ok_or(anyhow!("Missing is_extended_id field"))?
-            == "true";
-        let bus_no = fields.next().ok_or(anyhow!("Missing bus field"))?.parse()?;
+            == b"true";
+        let bus_no = parse_field(fields.next().ok_or(anyhow!("Missing bus field"))?, 10)?;
         fields.next(); // dlen field, can skip this one
 
-        // collect the remaining variable number of data fields d1..d8
-        let data = fields
-            .map(|d| u8::from_str_radix(d, 16))
-            .try_collect()
-            .context("Error parsing CSV data field")?;
+        // collect the remaining variable number of data fields d1..d8,
+        // allocating the payload once at its final size
+        let mut data: Vec<u8> = Vec::with_capacity(record.len().saturating_sub(5));
+        for d in fields {
+            data.push(parse_field(d, 16).context("Error parsing CSV data field")?);
+        }
 
         Ok(CANMessage {
             timestamp: (ts_us * 1000) as Nanos - ts_offs,
             can_id,
             is_extended_id,
             bus_no,
-            data,
+            data: data.into_boxed_slice(),
         })
     }
 
@@ -116,6 +143,10 @@ impl CANMessage {
     }
 }
 
+// CAN logs are often hundreds of MB, so read them in large blocks rather than
+// the csv crate's default 8KB
+const CSV_BUFFER_CAPACITY: usize = 1024 * 1024;
+
 pub fn read_can_messages(
     csv_log_path: &Path,
     can_ts_offs: Option<Nanos>,
@@ -124,40 +155,49 @@ pub fn read_can_messages(
 
     let mut rdr = csv::ReaderBuilder::new()
         .flexible(true)
+        .buffer_capacity(CSV_BUFFER_CAPACITY)
+        // The log format never quotes fields, so skip the quote handling states
+        .quoting(false)
         .from_path(csv_log_path)
         .with_context(|| format!("Failed to read CSV file {:?}", csv_log_path))?;
 
-    let mut records = rdr.records().peekable();
-
-    let can_ts_offs = can_ts_offs.unwrap_or_else(|| match records.peek() {
+    // Parse every row into the same record buffer, rather than allocating a
+    // new record per row. Fields are parsed as raw bytes, see parse_field()
+    let mut record = csv::ByteRecord::new();
+    let mut can_ts_offs = can_ts_offs;
+    let mut result: Vec<CANMessage> = vec![];
+    let mut in_order = true;
+
+    while rdr
+        .read_byte_record(&mut record)
+        .map_err(|e| anyhow!("Invalid CSV record in file {:?}: {}", csv_log_path, e))?
+    {
         // If no timestamp offset was specified, offset so the first message
         // has timestamp 0
-        Some(Ok(record)) => match CANMessage::parse_from(record, 0) {
-            Ok(message) => message.timestamp(),
-            _ => 0,
-        },
-        _ => 0,
-    });
-
-    let mut result = records
-        .map(|rec| match rec {
-            Ok(r) => CANMessage::parse_from(&r, can_ts_offs),
-            Err(e) => Err(anyhow!(
-                "Invalid CSV record in file {:?}: {}",
-                csv_log_path,
-                e
-            )),
-        })
+        let ts_offs =
+            *can_ts_offs.get_or_insert_with(|| match CANMessage::parse_from(&record, 0) {
+                Ok(message) => message.timestamp(),
+                _ => 0,
+            });
+
+        let message = CANMessage::parse_from(&record, ts_offs)?;
+
         // TODO: For now dropping any CAN timestamp that comes before the video
         // started. Could conceivably adjust the start earlier instead and have empty video
-        .filter(|r| match r {
-            Ok(m) => m.timestamp >= 0,
-            _ => true,
-        })
-        .collect::<Result<Vec<CANMessage>>>()?;
+        if message.timestamp >= 0 {
+            if let Some(last) = result.last() {
+                in_order &= last.timestamp <= message.timestamp;
+            }
+            result.push(message);
+        }
+    }
+
     // When the log contains >1 bus of data, the messages can be slightly out
-    // of order
-    result.sort();
+    // of order, so sort only if that happened. The sort is stable so messages
+    // with equal timestamps keep their order from the file.
+    if !in_order {
+        result.sort();
+    }
     Ok(result)
 }
 
@@ -237,3 +277,46 @@ pub fn expand_alerts(alerts: Vec<Alert>) -> Vec<LogInput> {
 
     result
 }
+
+#[cfg(test)]
+mod tests {
+    use super::parse_field;
+
+    #[test]
+    fn parse_decimal_and_hex() {
+        assert_eq!(parse_field::<u8>(b"3", 10).unwrap(), 3);
+        assert_eq!(parse_field::<u32>(b"7Df", 16).unwrap(), 0x7df);
+        assert_eq!(parse_field::<u32>(b"1FFFFFFF", 16).unwrap(), 0x1fff_ffff);
+        assert_eq!(parse_field::<u8>(b"aB", 16).unwrap(), 0xab);
+    }
+
+    #[test]
+    fn parse_timestamp() {
+        assert_eq!(
+            parse_field::<i64>(b"1469445700", 10).unwrap(),
+            1_469_445_700
+        );
+        assert_eq!(
+            parse_field::<i64>(b"9223372036854775807", 10).unwrap(),
+            i64::MAX
+        );
+        assert!(parse_field::<i64>(b"9223372036854775808", 10).is_err());
+    }
+
+    #[test]
+    fn parse_invalid() {
+        assert!(parse_field::<u8>(b"", 16).is_err());
+        assert!(parse_field::<u8>(b"x1", 16).is_err());
+        assert!(parse_field::<u8>(b" 1", 10).is_err());
+        assert!(parse_field::<u8>(b"a", 10).is_err());
+        assert!(parse_field::<i64>(b"-5", 10).is_err());
+    }
+
+    #[test]
+    fn parse_overflow() {
+        assert!(parse_field::<u8>(b"100", 16).is_err());
+        assert!(parse_field::<u8>(b"256", 10).is_err());
+        assert!(parse_field::<u32>(b"100000000", 16).is_err());
+        assert!(parse_field::<u64>(b"10000000000000000", 16).is_err());
+    }
+}
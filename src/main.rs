@@ -1,6 +1,6 @@
 // Copyright (c) 2023 Angus Gratton
 // SPDX-License-Identifier: GPL-2.0-or-later
-use anyhow::{bail, Context, Result};
+use anyhow::{anyhow, bail, Context, Result};
 use chrono::{DateTime, Local};
 use clap::Parser;
 use itertools::{merge, Itertools};
@@ -9,13 +9,17 @@ use make_cabana_route::input::{
 };
 use make_cabana_route::log_capnp::sentinel::SentinelType;
 use make_cabana_route::qlog::QlogWriter;
-use make_cabana_route::video::{SegmentVideoEncoder, SourceVideo};
+use make_cabana_route::video::{BackgroundSegmentEncoder, SourceVideo};
 use make_cabana_route::Nanos;
 use serde::Deserialize;
+use std::collections::{HashMap, VecDeque};
 use std::fs::{self, File, Permissions};
 use std::io::Write;
+use std::num::NonZeroUsize;
 use std::os::unix::prelude::PermissionsExt;
 use std::path::{Path, PathBuf};
+use std::sync::atomic::{AtomicUsize, Ordering};
+use std::thread;
 use std::time::Duration;
 
 // Duration of a route segment
@@ -38,6 +42,14 @@ struct Args {
     #[arg(short, long, default_value = "data_dir")]
     data_dir: PathBuf,
 
+    /// Number of logs to process at once
+    #[arg(short, long, default_value = "1")]
+    jobs: NonZeroUsize,
+
+    /// Maximum number of segment videos to encode at once (per log)
+    #[arg(long, default_value = "2")]
+    parallel_encodes: NonZeroUsize,
+
     /// Optional filter. If set, only process logs containing this string.
     filter_by: Option<String>,
 }
@@ -77,6 +89,10 @@ impl LogInfo {
             self.video = Some(video);
         }
 
+        // Resolve the route timestamp once now, rather than reading file
+        // metadata again each time a segment directory path is needed
+        self.route_timestamp = Some(self.route_timestamp());
+
         Ok(())
     }
 
@@ -104,20 +120,23 @@ impl LogInfo {
         }
     }
 
-    // Segment directories in the data directory are based on the route timestamp,
-    // plus a suffix for the segment number
+    // Routes are named after the route timestamp, to the nearest second
     //
     // See replay Route::parseRoute() in openpilot for the regex that resolves the route name.
     //
     // Routes also have an optional 16 character hex suffix field with the dongle ID.
     // Currently leave this off, it looks like Cabana is happy without it.
+    fn route_name(&self) -> String {
+        self.route_timestamp()
+            .format("%Y-%m-%d--%H-%M-%S")
+            .to_string()
+    }
+
+    // Segment directories in the data directory are based on the route name,
+    // plus a suffix for the segment number
     fn segment_dir_path(&self, data_dir: &Path, segment_idx: i64) -> PathBuf {
         let mut result = data_dir.to_path_buf();
-        result.push(format!(
-            "{}--{}",
-            self.route_timestamp().format("%Y-%m-%d--%H-%M-%S"),
-            segment_idx
-        ));
+        result.push(format!("{}--{}", self.route_name(), segment_idx));
         result
     }
 
@@ -180,20 +199,81 @@ fn main() -> Result<()> {
         info.canonicalise_paths(&args.yaml_path)?
     }
 
+    let logs: Vec<&LogInfo> = logs
+        .iter()
+        .filter(|info| match args.filter_by {
+            Some(ref filter_by) => info.log_matches(filter_by),
+            None => true,
+        })
+        .collect();
+
+    // Logs with the same route name would write to the same segment directories
+    // (at the same time, if processed in parallel), so don't allow this
+    let mut route_names: HashMap<String, &LogInfo> = HashMap::new();
     for info in &logs {
-        if let Some(ref filter_by) = args.filter_by {
-            if !info.log_matches(filter_by) {
-                continue;
-            }
+        if let Some(other) = route_names.insert(info.route_name(), info) {
+            bail!(
+                "Logs {:?} and {:?} both have route timestamp {}. Set a different \
+                 route_timestamp for one of them in {:?}",
+                other.logfile,
+                info.logfile,
+                info.route_name(),
+                args.yaml_path
+            );
         }
-
-        process_log(info, &args.data_dir)?;
     }
 
-    Ok(())
+    // Each worker thread takes the next unprocessed log from the list, until
+    // there are none left
+    let next_log = AtomicUsize::new(0);
+
+    let errors: Vec<anyhow::Error> = thread::scope(|scope| {
+        let workers: Vec<_> = (0..args.jobs.get().min(logs.len()))
+            .map(|_| {
+                scope.spawn(|| -> Result<()> {
+                    while let Some(info) = logs.get(next_log.fetch_add(1, Ordering::Relaxed)) {
+                        if let Err(e) =
+                            process_log(info, &args.data_dir, args.parallel_encodes.get())
+                        {
+                            // Stop the other workers from starting any new logs. Logs
+                            // already in progress still run to completion. The failed
+                            // log's video encoders and qlog compressors have already been
+                            // joined when process_log() dropped them.
+                            next_log.store(logs.len(), Ordering::Relaxed);
+                            return Err(e).with_context(|| {
+                                format!("Failed to process log {:?}", info.logfile)
+                            });
+                        }
+                    }
+                    Ok(())
+                })
+            })
+            .collect();
+
+        // Wait for every worker before reporting anything, as more than one log
+        // may fail when processing in parallel
+        workers
+            .into_iter()
+            .filter_map(|worker| match worker.join() {
+                Ok(result) => result.err(),
+                Err(_) => Some(anyhow!("Log processing thread panicked")),
+            })
+            .collect()
+    });
+
+    match errors.len() {
+        0 => Ok(()),
+        1 => Err(errors.into_iter().next().unwrap()),
+        n => {
+            for e in errors {
+                eprintln!("Error: {:?}\n", e);
+            }
+            bail!("{} logs failed", n);
+        }
+    }
 }
 
-fn process_log(info: &LogInfo, data_dir: &Path) -> Result<()> {
+fn process_log(info: &LogInfo, data_dir: &Path, parallel_encodes: usize) -> Result<()> {
     if info.video.is_some() && info.sync.is_none() {
         bail!("Video {0:?} requires a sync section to match", info.video);
     }
@@ -241,6 +321,16 @@ fn process_log(info: &LogInfo, data_dir: &Path) -> Result<()> {
     let segments = inputs.group_by(|input| input.timestamp() / SEGMENT_NANOS);
     let mut first_video = true;
 
+    // qlog of the previous segment, which may still be compressing in the background
+    let mut pending_qlog: Option<QlogWriter> = None;
+
+    // Segment videos still encoding in the background, oldest first
+    let mut pending_videos: VecDeque<(PathBuf, BackgroundSegmentEncoder)> = VecDeque::new();
+
+    // Batch of CAN messages for the next CAN event. Reused for the whole log,
+    // so it stops reallocating once it has grown to the largest batch size.
+    let mut can_msgs: Vec<CANMessage> = vec![];
+
     for (segment_idx, inputs) in &segments {
         let mut inputs = inputs.peekable();
 
@@ -257,7 +347,7 @@ fn process_log(info: &LogInfo, data_dir: &Path) -> Result<()> {
 
         let mut segment_video = if let Some(properties) = &video_properties {
             if !seg_video_path.try_exists()? {
-                let enc = SegmentVideoEncoder::new(&seg_video_path, properties, first_video)?;
+                let enc = BackgroundSegmentEncoder::spawn(&seg_video_path, properties, first_video);
                 first_video = false;
                 Some(enc)
             } else {
@@ -282,8 +372,6 @@ fn process_log(info: &LogInfo, data_dir: &Path) -> Result<()> {
 
         let mut last_thumbnail: Nanos = 0;
 
-        let mut can_msgs: Vec<CANMessage> = vec![];
-
         for input in inputs {
             // Flush the current set of CAN messages to an event
             // in qlog whenever CAN_EVENT_LEN time has passed
@@ -297,12 +385,8 @@ fn process_log(info: &LogInfo, data_dir: &Path) -> Result<()> {
                 LogInput::CAN(can_msg) => {
                     can_msgs.push(can_msg);
                 }
-                LogInput::Frame(ref frame) => {
-                    let ts = input.timestamp();
-
-                    if let Some(ref mut encode) = segment_video {
-                        encode.send_frame(frame)?;
-                    }
+                LogInput::Frame(frame) => {
+                    let ts = frame.ts_ns;
 
                     qlog.write_frame_encode_idx(ts, segment_idx as i32, frame_id);
                     if ts - last_thumbnail > THUMBNAIL_INTERVAL {
@@ -311,6 +395,10 @@ fn process_log(info: &LogInfo, data_dir: &Path) -> Result<()> {
                         last_thumbnail = ts;
                     }
 
+                    if let Some(ref mut encode) = segment_video {
+                        encode.send_frame(frame.frame)?;
+                    }
+
                     frame_id += 1;
                 }
                 LogInput::Alert(ref alert) => {
@@ -321,19 +409,32 @@ fn process_log(info: &LogInfo, data_dir: &Path) -> Result<()> {
 
         // Flush any final batch of CAN messages
         qlog.write_can(&can_msgs);
-
-        if let Some(encode) = segment_video {
-            encode.finish()?;
-
-            if frame_id == 0 {
-                // No frames actually got written for this segment, so get rid of the
-                // zero byte video file (otherwise Openpilot complains)
-                println!("Warning: empty video segment. CAN log probably runs longer than video");
-                std::fs::remove_file(seg_video_path)?;
+        can_msgs.clear();
+
+        if let Some(mut encode) = segment_video {
+            // Let the encoder finish in the background, but only keep up to
+            // parallel_encodes of them running at once
+            encode.end_of_input();
+            pending_videos.push_back((seg_video_path, encode));
+            while pending_videos.len() >= parallel_encodes {
+                let (path, encode) = pending_videos.pop_front().unwrap();
+                finish_segment_video(&path, encode)?;
             }
         }
 
         qlog.write_sentinel(0, SentinelType::EndOfSegment);
+
+        if let Some(prev_qlog) = pending_qlog.replace(qlog) {
+            prev_qlog.finish()?;
+        }
+    }
+
+    if let Some(qlog) = pending_qlog {
+        qlog.finish()?;
+    }
+
+    for (path, encode) in pending_videos {
+        finish_segment_video(&path, encode)?;
     }
 
     write_launch_script(info, data_dir)?;
@@ -341,6 +442,16 @@ fn process_log(info: &LogInfo, data_dir: &Path) -> Result<()> {
     Ok(())
 }
 
+fn finish_segment_video(seg_video_path: &Path, encode: BackgroundSegmentEncoder) -> Result<()> {
+    if encode.finish()? == 0 {
+        // No frames actually got written for this segment, so get rid of the
+        // zero byte video file (otherwise Openpilot complains)
+        println!("Warning: empty video segment. CAN log probably runs longer than video");
+        std::fs::remove_file(seg_video_path)?;
+    }
+    Ok(())
+}
+
 fn write_launch_script(info: &LogInfo, data_dir: &Path) -> Result<()> {
     /* Cabana doesn't have much of a feature for browsing local routes, so much a bunch of
     launcher scripts based on the CSV log file name.
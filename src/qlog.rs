@@ -4,31 +4,109 @@ use crate::input::{Alert, AlertStatus, CANMessage};
 use crate::log_capnp;
 use crate::log_capnp::sentinel::SentinelType;
 use crate::Nanos;
-use anyhow::{Context, Result};
+use anyhow::{anyhow, Context, Result};
 use bzip2::write::BzEncoder;
 use bzip2::Compression;
+use capnp::message::{HeapAllocator, SUGGESTED_FIRST_SEGMENT_WORDS};
 use std::fs::File;
+use std::io::Write;
 use std::path::PathBuf;
+use std::sync::mpsc::{self, SyncSender};
+use std::thread::{self, JoinHandle};
+
+// Serialized events are batched into chunks of about this size before being
+// sent for compression, rather than sending each (mostly tiny) event alone
+const COMPRESS_CHUNK_BYTES: usize = 1024 * 1024;
+
+// Maximum number of chunks waiting to be compressed. If bzip2 falls behind,
+// writing blocks rather than buffering the whole segment in memory.
+const COMPRESS_QUEUE_CHUNKS: usize = 4;
+
+// Generous estimate of the size of an Event struct in 64-bit words, not
+// counting any variable length content
+const EVENT_WORDS: u32 = 16;
 
 // Struct to wrap writing an qlog.bz2 file
+//
+// Serialized events are sent to a separate thread for bzip2 compression, so
+// compression runs in parallel with producing the rest of the log. If this is
+// dropped without calling finish(), it still waits for the compressor thread so
+// the qlog file is left as a valid bz2 stream.
 pub struct QlogWriter {
     last_timestamp: Nanos,
-    writer: BzEncoder<File>,
+    buf: Vec<u8>,
+    sender: Option<SyncSender<Vec<u8>>>,
+    compressor: Option<JoinHandle<Result<()>>>,
 }
 
 impl QlogWriter {
     pub fn new(path: PathBuf) -> Result<Self> {
         let f =
             File::create(&path).with_context(|| format!("Failed to create file {:?}", &path))?;
-        let writer = BzEncoder::new(f, Compression::new(6));
+        let (sender, receiver) = mpsc::sync_channel::<Vec<u8>>(COMPRESS_QUEUE_CHUNKS);
+
+        let compressor = thread::spawn(move || -> Result<()> {
+            let mut writer = BzEncoder::new(f, Compression::new(6));
+            for buf in receiver {
+                writer
+                    .write_all(&buf)
+                    .with_context(|| format!("Failed to write {:?}", &path))?;
+            }
+            writer
+                .finish()
+                .with_context(|| format!("Failed to finish writing {:?}", &path))?;
+            Ok(())
+        });
+
         Ok(Self {
-            writer,
+            buf: Vec::with_capacity(COMPRESS_CHUNK_BYTES),
+            sender: Some(sender),
+            compressor: Some(compressor),
             last_timestamp: 0,
         })
     }
 
+    // Wait for all events to be compressed and written to the qlog file
+    pub fn finish(mut self) -> Result<()> {
+        self.close()
+    }
+
+    fn close(&mut self) -> Result<()> {
+        // Send any partly filled chunk, so no events are lost even on the drop path
+        if !self.buf.is_empty() {
+            self.send_chunk(std::mem::take(&mut self.buf));
+        }
+        self.sender.take(); // Closing the channel tells the compressor thread to finish
+        match self.compressor.take() {
+            Some(compressor) => compressor
+                .join()
+                .map_err(|_| anyhow!("qlog compressor thread panicked"))?,
+            None => Ok(()),
+        }
+    }
+
+    fn send_chunk(&mut self, chunk: Vec<u8>) {
+        if let Some(sender) = &self.sender {
+            // If this fails then the compressor thread has stopped with an error,
+            // which is returned from finish()
+            let _ = sender.send(chunk);
+        }
+    }
+
     fn write_event(&mut self, mono_time: Nanos, fill_event_cb: impl Fn(log_capnp::event::Builder)) {
-        let mut message = ::capnp::message::Builder::new_default();
+        self.write_sized_event(mono_time, SUGGESTED_FIRST_SEGMENT_WORDS, fill_event_cb);
+    }
+
+    // As write_event(), but allocates space for an event of about 'words' 64-bit words up front.
+    // Events that fit are built in a single allocation, instead of capnp growing extra segments.
+    fn write_sized_event(
+        &mut self,
+        mono_time: Nanos,
+        words: u32,
+        fill_event_cb: impl Fn(log_capnp::event::Builder),
+    ) {
+        let allocator = HeapAllocator::new().first_segment_words(words);
+        let mut message = ::capnp::message::Builder::new(allocator);
         let mut event = message.init_root::<log_capnp::event::Builder>();
 
         // If necessary make the timestamps monotonic
@@ -37,7 +115,13 @@ impl QlogWriter {
         event.set_valid(true);
         event.set_log_mono_time(self.last_timestamp as u64);
         fill_event_cb(event);
-        capnp::serialize::write_message(&mut self.writer, &message).unwrap();
+
+        capnp::serialize::write_message(&mut self.buf, &message).unwrap();
+
+        if self.buf.len() >= COMPRESS_CHUNK_BYTES {
+            let chunk = std::mem::replace(&mut self.buf, Vec::with_capacity(COMPRESS_CHUNK_BYTES));
+            self.send_chunk(chunk);
+        }
     }
 
     pub fn write_init_data(&mut self, mono_time: Nanos) {
@@ -66,7 +150,14 @@ impl QlogWriter {
             return;
         }
 
-        self.write_event(can_msgs[0].timestamp(), |event| {
+        // Each CanData is 2 words, plus its data rounded up to whole words
+        let words = EVENT_WORDS
+            + can_msgs
+                .iter()
+                .map(|msg| 2 + (msg.data.len() as u32).div_ceil(8))
+                .sum::<u32>();
+
+        self.write_sized_event(can_msgs[0].timestamp(), words, |event| {
             let len = can_msgs.len().try_into().unwrap();
             let mut can_evt = event.init_can(len);
             for (idx, msg) in can_msgs.iter().enumerate() {
@@ -100,7 +191,9 @@ impl QlogWriter {
         frame_id: u32,
         jpeg_data: &[u8],
     ) {
-        self.write_event(mono_time, |event| {
+        let words = EVENT_WORDS + (jpeg_data.len() as u32).div_ceil(8);
+
+        self.write_sized_event(mono_time, words, |event| {
             let mut thumbnail = event.init_thumbnail();
             thumbnail.set_frame_id(frame_id);
             thumbnail.set_timestamp_eof(end_ts as u64);
@@ -143,6 +236,14 @@ impl QlogWriter {
     }
 }
 
+impl Drop for QlogWriter {
+    fn drop(&mut self) {
+        if let Err(e) = self.close() {
+            eprintln!("Failed to finish qlog: {e:#}");
+        }
+    }
+}
+
 impl From<AlertStatus> for log_capnp::controls_state::AlertStatus {
     fn from(val: AlertStatus) -> Self {
         match val {
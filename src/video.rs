@@ -1,13 +1,15 @@
 // Copyright (c) 2023 Angus Gratton
 // SPDX-License-Identifier: GPL-2.0-or-later
-use anyhow::{Context, Result};
+use anyhow::{anyhow, Context, Result};
 use ffmpeg::{
     codec, decoder, encoder, format, frame, media, software::scaling, Dictionary, Packet, Rational,
 };
 use jpeg_encoder;
-use std::cell::RefCell;
+use std::cell::{OnceCell, RefCell};
 use std::path::{Path, PathBuf};
 use std::rc::Rc;
+use std::sync::mpsc::{self, SyncSender};
+use std::thread::{self, JoinHandle};
 
 const TARGET_FPS: u32 = 20;
 
@@ -21,6 +23,9 @@ const JPEG_MAX_WIDTH: u32 = 640;
 const VIDEO_MAX_WIDTH: u32 = 1280;
 /// Maximum width of the output video frame
 
+// Number of decoded frames that can be queued up for each background encoder
+const ENCODER_QUEUE_FRAMES: usize = TARGET_FPS as usize;
+
 pub struct SegmentVideoEncoder {
     octx: format::context::Output,
     encoder: encoder::Video,
@@ -82,9 +87,9 @@ impl SegmentVideoEncoder {
         })
     }
 
-    pub fn send_frame(&mut self, frame: &SourceFrame) -> Result<()> {
+    pub fn send_frame(&mut self, frame: &frame::Video) -> Result<()> {
         self.encoder
-            .send_frame(&frame.frame)
+            .send_frame(frame)
             .context("Failed to send frame to encoder")?;
         self.receive_packets()
             .context("Failed to read input video packets")?;
@@ -116,10 +121,100 @@ impl SegmentVideoEncoder {
     }
 }
 
+// Runs a SegmentVideoEncoder on its own thread, so encoding a segment overlaps
+// with decoding the source video (and with encoding other segments).
+//
+// Once end_of_input() has been called, dropping this still waits for the encoder
+// thread so the segment video is completed. If the encoder fails, or is dropped
+// before all of its frames were sent, the partial video file is deleted instead.
+// Otherwise it would look complete and be skipped on the next run.
+pub struct BackgroundSegmentEncoder {
+    path: PathBuf,
+    sender: Option<SyncSender<frame::Video>>,
+    thread: Option<JoinHandle<Result<usize>>>,
+}
+
+impl BackgroundSegmentEncoder {
+    pub fn spawn(path: &Path, properties: &VideoProperties, dump_info: bool) -> Self {
+        let (sender, receiver) = mpsc::sync_channel::<frame::Video>(ENCODER_QUEUE_FRAMES);
+        let thread_path = path.to_path_buf();
+        let properties = properties.clone();
+
+        let thread = thread::spawn(move || -> Result<usize> {
+            let mut encoder = SegmentVideoEncoder::new(&thread_path, &properties, dump_info)?;
+            for frame in receiver {
+                encoder.send_frame(&frame)?;
+            }
+            let frame_count = encoder.frame_count;
+            encoder.finish()?;
+            Ok(frame_count)
+        });
+
+        Self {
+            path: path.to_path_buf(),
+            sender: Some(sender),
+            thread: Some(thread),
+        }
+    }
+
+    pub fn send_frame(&mut self, frame: frame::Video) -> Result<()> {
+        let sent = match &self.sender {
+            Some(sender) => sender.send(frame).is_ok(),
+            None => false,
+        };
+        if !sent {
+            // The encoder thread only hangs up early if it failed, so return its error
+            self.close()?;
+            return Err(anyhow!("Video encoder thread exited early"));
+        }
+        Ok(())
+    }
+
+    // Signal that every frame of the segment has been sent. Encoding carries
+    // on in the background until finish() is called.
+    pub fn end_of_input(&mut self) {
+        self.sender.take(); // Closing the queue tells the encoder thread to finish
+    }
+
+    // Wait for all queued frames to be encoded, returns the number of frames
+    // in the segment video
+    pub fn finish(mut self) -> Result<usize> {
+        self.end_of_input();
+        self.close()
+    }
+
+    fn close(&mut self) -> Result<usize> {
+        let input_complete = self.sender.take().is_none();
+        let result = join_encoder(self.thread.take());
+        if result.is_err() || !input_complete {
+            let _ = std::fs::remove_file(&self.path);
+        }
+        result
+    }
+}
+
+impl Drop for BackgroundSegmentEncoder {
+    fn drop(&mut self) {
+        if self.thread.is_some() {
+            if let Err(e) = self.close() {
+                eprintln!("Failed to finish segment video {:?}: {e:#}", self.path);
+            }
+        }
+    }
+}
+
+fn join_encoder(thread: Option<JoinHandle<Result<usize>>>) -> Result<usize> {
+    thread
+        .ok_or(anyhow!("Video encoder thread already exited"))?
+        .join()
+        .map_err(|_| anyhow!("Video encoder thread panicked"))?
+}
+
 pub struct SourceVideo {
     video_file: PathBuf,
     ictx: format::context::Input,
     video_stream_index: usize,
+    properties: OnceCell<VideoProperties>,
 }
 
 // It's hard to borrow the source ffmpeg Video struct for each encoding session, as
@@ -173,6 +268,7 @@ impl SourceVideo {
             ictx,
             video_stream_index,
             video_file: video_file.to_path_buf(),
+            properties: OnceCell::new(),
         })
     }
 
@@ -206,10 +302,14 @@ impl SourceVideo {
         )
         .expect("Failed to initialize JPEG scaler context");
         let jpeg_scaler_context = Rc::new(RefCell::new(jpeg_scaler_context));
+        let time_base = decoder.time_base().context("Video must have time base")?;
+        let timebase_ns =
+            (time_base.numerator() as i64 * 1_000_000_000) / time_base.denominator() as i64;
         let packets = self.ictx.packets();
         Ok(SourceFrameIterator {
             packets,
             decoder,
+            timebase_ns,
             video_stream_index: self.video_stream_index,
             jpeg_scaler_context,
             next_frame_ts: 0,
@@ -217,20 +317,27 @@ impl SourceVideo {
     }
 
     pub fn properties(&self) -> Result<VideoProperties> {
+        // Reading these requires opening a decoder, so only do it once
+        if let Some(properties) = self.properties.get() {
+            return Ok(properties.clone());
+        }
+
         let decoder = self.video_decoder()?;
-        Ok(VideoProperties {
+        let properties = VideoProperties {
             height: decoder.height(),
             width: decoder.width(),
             format: decoder.format(),
             time_base: decoder.time_base(),
             color_space: decoder.color_space(),
             color_range: decoder.color_range(),
-        })
+        };
+        Ok(self.properties.get_or_init(|| properties).clone())
     }
 }
 
 pub struct SourceFrameIterator<'a> {
     decoder: decoder::Video,
+    timebase_ns: i64,
     packets: format::context::input::PacketIter<'a>,
     video_stream_index: usize,
     jpeg_scaler_context: Rc<RefCell<scaling::Context>>,
@@ -241,10 +348,8 @@ impl<'a> Iterator for SourceFrameIterator<'a> {
     type Item = SourceFrame;
 
     fn next(&mut self) -> Option<Self::Item> {
+        let timebase_ns = self.timebase_ns;
         let mut receive_frames = |decoder: &mut decoder::Video| -> Option<Self::Item> {
-            let time_base = decoder.time_base().expect("Video must have time base");
-            let timebase_ns =
-                (time_base.numerator() as i64 * 1_000_000_000) / time_base.denominator() as i64;
             let jpeg_scaler_context = self.jpeg_scaler_context.clone();
 
             let mut frame = frame::Video::empty();